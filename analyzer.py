@@ -1,17 +1,65 @@
 from pathlib import Path
 import logging
-import re
+import codecs
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import shutil
 from zipfile import ZipFile
 from zipfile import BadZipFile
-from progress.bar import Bar
 from chardet.universaldetector import UniversalDetector
 
 import util
 
 
+# Returns True if the filename looks like a C/C++ header (e.g. 'foo.h' or 'foo.hpp', but not '.h').
+def _is_header_filename(name):
+    (stem, _, ext) = name.rpartition('.')
+    return stem != '' and ext in ('h', 'hpp')
+
+
+# The charset detector allocates many probers on construction. It is only needed for the few sketches that are not
+# UTF-8, so the instance is created on the first use and then reset and reused within the (worker) process.
+_charset_detector = None
+
+
+def _get_charset_detector():
+    global _charset_detector
+    if _charset_detector is None:
+        _charset_detector = UniversalDetector()
+    else:
+        _charset_detector.reset()
+    return _charset_detector
+
+
+# Returns the name of the example sketch if the archive entry f is the main source of an example sketch, or None
+# otherwise. An Arduino sketch is a '.ino' (or '.pde') file named after its directory, and the examples are in the
+# examples directory of the library (e.g. 'Foo/examples/Basic/Basic.ino').
+def _get_example_sketch_name(f):
+    idx = f.find('/examples/')
+    # The examples directory must be on the root directory of the library
+    if idx <= 0 or f.find('/') != idx:
+        return None
+    parts = f[idx + len('/examples/'):].split('/')
+    if len(parts) < 2:
+        return None
+    (name, _, ext) = parts[-1].rpartition('.')
+    if ext not in ('ino', 'pde') or name == '' or name != parts[-2]:
+        return None
+    return name
+
+
 class Analyzer:
     HEADERS_FILENAME = 'headers.toml'
+    ANALYSIS_CACHE_FILENAME = 'analysis_cache.toml'
+    # The cached results are discarded if the cache was written with another version. Increment this whenever the
+    # results of scan_archive change (e.g. the include scanning), so that the cached archives are analyzed again.
+    ANALYSIS_CACHE_VERSION = 1
+    # Number of the threads looking up the library archives
+    N_LOOKUP_THREADS = 8
+    # Size of the chunks fed to the charset detector
+    DETECTION_CHUNK_SIZE = 64 * 1024
+    # Number of the sketch contents whose headers are remembered (per worker process)
+    SKETCH_CACHE_SIZE = 1024
 
     def __init__(self, db, temp_dir):
         self.database = db
@@ -28,30 +76,14 @@ class Analyzer:
         lib_info_list = self.database.get_library_info_list()
         self.n_libraries = len(lib_info_list)
         self.n_example_sketches = 0
+        self.n_failed_example_sketches = 0
         print('Looking for library headers from {} libraries...'.format(self.n_libraries))
         self.n_failed_libraries = 0
-        bar = Bar('PROGRESS', max=self.n_libraries)
-        for lib_info in self.database.get_library_info_list():
-            headers = self.get_headers_for_library(lib_info.path)
-            if headers is None:
-                logging.error('Analysis failed with the library: {}-{}'.format(lib_info.name, lib_info.version))
-                self.n_failed_libraries += 1
-            else:
-                self.database.add_header_dictionary_entry(lib_info, headers)
-                (is_ok, example_headers) = self.get_headers_in_examples(lib_info.path)
-                if not is_ok:
-                    logging.error('Analysis failed with the library: {}-{}'.format(lib_info.name, lib_info.version))
-                    self.n_failed_libraries += 1
-                for (example_name, example_headers) in example_headers:
-                    feature_headers = set(headers) & set(example_headers)
-                    self.database.add_feature_database_entry(lib_info, example_name, feature_headers)
-                if len(headers) == 0 and len(example_headers) != 0:
-                    logging.warning(
-                        'Found examples but the library has no header in its source directory.: {}-{}'
-                        .format(lib_info.name, lib_info.version)
-                    )
-            bar.next()
+        bar = util.BatchedBar('PROGRESS', max=self.n_libraries)
+        results = self.analyze_archives([lib_info.path for lib_info in lib_info_list], bar)
         bar.finish()
+        for (lib_info, res) in zip(lib_info_list, results):
+            self.add_analysis_result(lib_info, *res)
         print()
         print('{} libraries and {} example sketches were processed.'.format(self.n_libraries, self.n_example_sketches))
         if self.n_failed_libraries > 0:
@@ -64,50 +96,237 @@ class Analyzer:
             print()
             print('To investigate reasons for these failures, consult the log file for more information.')
 
-    # returns None on failure
-    def get_headers_for_library(self, library_path):
-        logging.info('Analyzing the library in path: {}...'.format(library_path))
-        ar = list(library_path.glob('*.zip'))[0]
+    # Returns the list of the results of scan_archive for the archive in each library path.
+    # The results for the archives unchanged since the last analysis are taken from the analysis cache.
+    def analyze_archives(self, library_paths, bar):
+        # Looking up the archives and their stamps is bound by the filesystem latency rather than the CPU, so it is
+        # overlapped with threads.
+        with ThreadPoolExecutor(max_workers=Analyzer.N_LOOKUP_THREADS) as executor:
+            located = list(executor.map(Analyzer.locate_archive, library_paths))
+        archive_paths = [ar for (ar, _) in located]
+        stamps = [stamp for (_, stamp) in located]
+        cache = self.read_analysis_cache()
+        new_cache = {}
+        results = [None] * len(archive_paths)
+        keys = [ar.relative_to(self.database.root_path).as_posix() for ar in archive_paths]
+        missed = []
+        for (i, key) in enumerate(keys):
+            entry = cache.get(key)
+            if entry is not None and entry['stamp'] == stamps[i]:
+                results[i] = Analyzer.restore_analysis_result(entry)
+                new_cache[key] = entry
+                bar.next()
+            else:
+                missed.append(i)
+        logging.info('Reusing the analysis results for {} libraries.'.format(len(archive_paths) - len(missed)))
+        # The libraries are analyzed in the worker processes. The results are put in the database by this process.
+        with ProcessPoolExecutor(initializer=util.init_worker_logging,
+                                 initargs=util.get_worker_logging_config()) as executor:
+            missed_results = executor.map(Analyzer.scan_archive, [archive_paths[i] for i in missed], chunksize=8)
+            for (i, res) in zip(missed, missed_results):
+                results[i] = res
+                entry = Analyzer.make_analysis_cache_entry(stamps[i], res)
+                if entry is not None:
+                    new_cache[keys[i]] = entry
+                bar.next()
+        self.write_analysis_cache(new_cache)
+        return results
+
+    # Returns (archive_path, stamp) for the library archive in library_path.
+    @staticmethod
+    def locate_archive(library_path):
+        ar = next(library_path.glob('*.zip'))
+        return ar, Analyzer.get_archive_stamp(ar)
+
+    # The modification time and the size identify the version of the archive without reading it.
+    @staticmethod
+    def get_archive_stamp(ar):
+        st = ar.stat()
+        return {'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+
+    # Only the successful results are cached so that the failures are reported (and retried) on every run.
+    @staticmethod
+    def make_analysis_cache_entry(stamp, result):
+        (headers, is_ok, example_headers, _, _) = result
+        if headers is None or not is_ok:
+            return None
+        return {
+            'stamp': stamp,
+            'headers': list(headers),
+            'examples': [{'name': name, 'headers': list(h)} for (name, h) in example_headers],
+        }
+
+    @staticmethod
+    def restore_analysis_result(entry):
+        example_headers = [(e['name'], list(e['headers'])) for e in entry['examples']]
+        return list(entry['headers']), True, example_headers, len(example_headers), 0
+
+    # Returns the cache entries by the archive path.
+    # A broken or outdated cache only costs a full analysis, so it is treated as empty.
+    def read_analysis_cache(self):
+        cache_path = Path(self.database.root_path, self.ANALYSIS_CACHE_FILENAME)
+        if not cache_path.exists():
+            return {}
+        try:
+            cache = self.database.read_toml_cached(cache_path)
+        except ValueError as e:
+            logging.warning('Ignoring the broken analysis cache: {} ({})'.format(cache_path, e))
+            return {}
+        if cache.get('version') != self.ANALYSIS_CACHE_VERSION:
+            logging.info('Ignoring the analysis cache of another version: {}'.format(cache_path))
+            return {}
+        return cache.get('archives', {})
+
+    def write_analysis_cache(self, cache):
+        self.database.write_toml_cached(Path(self.database.root_path, self.ANALYSIS_CACHE_FILENAME),
+                                        {'version': self.ANALYSIS_CACHE_VERSION, 'archives': cache})
+
+    def add_analysis_result(self, lib_info, headers, is_ok, example_headers, n_example_sketches,
+                            n_failed_example_sketches):
+        self.n_example_sketches += n_example_sketches
+        self.n_failed_example_sketches += n_failed_example_sketches
+        if headers is None:
+            logging.error('Analysis failed with the library: {}-{}'.format(lib_info.name, lib_info.version))
+            self.n_failed_libraries += 1
+            return
+        # Replace the headers found in the previous analysis (if any)
+        self.database.remove_header_dictionary_entries(lib_info)
+        self.database.add_header_dictionary_entry(lib_info, headers)
+        if not is_ok:
+            logging.error('Analysis failed with the library: {}-{}'.format(lib_info.name, lib_info.version))
+            self.n_failed_libraries += 1
+        # The library headers in each example are kept in their include order (without duplicates), so that the
+        # feature database is written the same in every run (the set order varies with the hash randomization).
+        header_set = set(headers)
+        self.database.add_feature_database_entries(
+            lib_info,
+            [(example_name, [h for h in dict.fromkeys(headers_in_example) if h in header_set])
+             for (example_name, headers_in_example) in example_headers]
+        )
+        if len(headers) == 0 and len(example_headers) != 0:
+            logging.warning(
+                'Found examples but the library has no header in its source directory.: {}-{}'
+                .format(lib_info.name, lib_info.version)
+            )
+
+    # Scan the library archive at the path ar for the headers and the example sketches.
+    # This runs in the worker processes, so the argument and the results must be picklable.
+    # Returns (headers, is_ok, example_headers, n_example_sketches, n_failed_example_sketches)
+    # where headers is None on failure.
+    @staticmethod
+    def scan_archive(ar):
+        logging.info('Analyzing the library archive: {}...'.format(ar))
         try:
             z = ZipFile(ar)
         except BadZipFile as ex:
             logging.error('Invalid Zip archive: {}'.format(ar))
             logging.error('Description: {}'.format(str(ex.args[0])))
-            return None
+            return None, False, [], 0, 0
         with z:
-            filenames = z.namelist()
-            headers = []
-            # Try the source directory
-            for f in filenames:
-                if re.fullmatch(r'^[^/]+/src/[^/]+[.](h|hpp)$', f):
-                    headers.append(str(Path(f).name))
-            if len(headers) > 0:
-                return headers
-            # Try the root directory
-            logging.debug('No headers in the src directory.')
-            logging.debug('Trying the packages root directory...')
-            for f in filenames:
-                if re.fullmatch(r'^[^/]+/[^/]+[.](h|hpp)$', f):
-                    headers.append(str(Path(f).name))
-            if len(headers) == 0:
-                logging.info('No header file found for the library with path: {}'.format(library_path))
-            return headers
-
-    def get_example_sketches(self, filenames):
-        # Look for the example sketches
+            # infolist() returns the archive's own list, while namelist() builds a new one
+            filenames = (zi.filename for zi in z.infolist() if not zi.is_dir())
+            (src_headers, root_headers, sketches) = Analyzer.classify_archive_entries(filenames)
+            # Prefer the source directory
+            if len(src_headers) > 0:
+                headers = src_headers
+            else:
+                # Fall back to the root directory
+                logging.debug('No headers in the src directory.')
+                logging.debug('Using the headers in the packages root directory...')
+                headers = root_headers
+                if len(headers) == 0:
+                    logging.info('No header file found for the library archive: {}'.format(ar))
+            if len(sketches) == 0:
+                logging.info('No example found for the library archive: {}'.format(ar))
+            (example_headers, n_failed_example_sketches) = Analyzer.get_headers_in_examples(z, sketches)
+        return headers, n_failed_example_sketches == 0, example_headers, len(sketches), n_failed_example_sketches
+
+    # Sort the archive entries into the headers in the source directory, the headers in the root directory and the
+    # example sketches.
+    # Returns (src_headers, root_headers, sketches)
+    @staticmethod
+    def classify_archive_entries(filenames):
+        src_headers = []
+        root_headers = []
         sketches = []
         for f in filenames:
-            m = re.fullmatch(r'^[^/]+/examples/(|.+/)(.+)/\2[.](ino|pde)$', f)
-            if m:
-                logging.debug('Found a sketch with name: {}'.format(m.group(2)))
-                sketches.append(f)
-        return sketches
+            parts = f.split('/')
+            if len(parts) == 3 and parts[0] != '' and parts[1] == 'src' and _is_header_filename(parts[2]):
+                src_headers.append(parts[2])
+            elif len(parts) == 2 and parts[0] != '' and _is_header_filename(parts[1]):
+                root_headers.append(parts[1])
+            else:
+                name = _get_example_sketch_name(f)
+                if name is not None:
+                    logging.debug('Found a sketch with name: {}'.format(name))
+                    sketches.append(f)
+        return src_headers, root_headers, sketches
 
-    def stringify_file_in_archive(self, zipfile, filename):
+    # Returns the list of the headers included by the sketch, or None if the sketch could not be decoded.
+    @staticmethod
+    def get_headers_in_sketch(zipfile, filename):
         with zipfile.open(filename) as f:
             data = f.read()
-        guesser = UniversalDetector()
-        guesser.feed(data)
+        headers = Analyzer.get_headers_in_sketch_data(data)
+        if headers is None:
+            logging.error('Could not decode the example sketch with path: {}'.format(filename))
+            return None
+        return list(headers)
+
+    # Consecutive versions of a library mostly ship the same example sketches, so the results are memoized by the
+    # content of the sketch.
+    # Returns the tuple of the included headers, or None if the sketch could not be decoded.
+    @staticmethod
+    @functools.lru_cache(maxsize=SKETCH_CACHE_SIZE)
+    def get_headers_in_sketch_data(data):
+        if not data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            # The include directives are plain ASCII, so for the ASCII compatible encodings (which covers most of the
+            # sketches) they can be looked up in the bytes without decoding the sketch.
+            if data.startswith(codecs.BOM_UTF8):
+                headers = util.get_included_headers_from_source_code_bytes(data[len(codecs.BOM_UTF8):])
+            else:
+                headers = util.get_included_headers_from_source_code_bytes(data)
+            if len(headers) > 0 or data.isascii():
+                return tuple(headers)
+        (source, is_exact) = Analyzer.decode_sketch(data)
+        headers = util.get_included_headers_from_source_code(source)
+        if len(headers) == 0 and not is_exact:
+            # The lossy decoding might have broken the include directives. Guess the encoding as the last resort.
+            source = Analyzer.decode_with_guessed_encoding(data)
+            if source is None:
+                return None
+            headers = util.get_included_headers_from_source_code(source)
+        return tuple(headers)
+
+    # Decode the sketch without guessing its encoding. The include directives are plain ASCII, so they survive even
+    # if the sketch is decoded as UTF-8 with replacement characters.
+    # Returns (source, is_exact) where is_exact is False if some bytes were replaced.
+    @staticmethod
+    def decode_sketch(data):
+        # The sketches are mostly plain ASCII, and otherwise mostly UTF-8.
+        if data.isascii():
+            return data.decode('ascii'), True
+        if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            try:
+                return data.decode('utf-16'), True
+            except UnicodeDecodeError:
+                return data.decode('utf-16', errors='replace'), False
+        # Note that 'utf-8-sig' also accepts the sources without the BOM.
+        try:
+            return data.decode('utf-8-sig'), True
+        except UnicodeDecodeError:
+            return data.decode('utf-8-sig', errors='replace'), False
+
+    # returns None on failure
+    @staticmethod
+    def decode_with_guessed_encoding(data):
+        # Feed the detector chunk by chunk so that it can stop as soon as it is confident about the encoding.
+        guesser = _get_charset_detector()
+        view = memoryview(data)
+        for i in range(0, len(view), Analyzer.DETECTION_CHUNK_SIZE):
+            guesser.feed(view[i:i + Analyzer.DETECTION_CHUNK_SIZE])
+            if guesser.done:
+                break
         guess = guesser.close()
         if guesser.done:
             encoding = guess['encoding']
@@ -119,42 +338,26 @@ class Analyzer:
         try:
             res = data.decode(encoding)
         except UnicodeError:
-            logging.error('Could not decode the example sketch with path: {}'.format(filename))
             res = None
         return res
 
-    # returns (is_ok, res)
-    def get_headers_in_examples(self, library_path):
+    # returns (res, n_failed_example_sketches)
+    @staticmethod
+    def get_headers_in_examples(zipfile, sketches):
         res = []
-        is_failed = False
-        logging.info('Analyzing the example sketches in path: {}...'.format(library_path))
-        ar = list(library_path.glob('*.zip'))[0]
-        try:
-            z = ZipFile(ar)
-        except BadZipFile as ex:
-            logging.error('Invalid Zip archive: {}'.format(ar))
-            logging.error('Description: {}'.format(str(ex.args[0])))
-            return False, []
-        with z:
-            filenames = z.namelist()
-            sketches = self.get_example_sketches(filenames)
-            if len(sketches) == 0:
-                logging.info('No example found for the library with path: {}'.format(library_path))
-            self.n_example_sketches += len(sketches)
-            for s in sketches:
-                res_source = self.stringify_file_in_archive(z, s)
-                if res_source is None:
-                    self.n_failed_example_sketches += 1
-                    is_failed = True
-                else:
-                    headers = util.get_included_headers_from_source_code(res_source)
-                    # To get the example sketch name with separating directories, first we preceding library archive
-                    # name and the examples directory name.
-                    example_name = s[s.find('/examples/') + len('/examples/'):]
-                    # and then, omit the actual sketch source code name.
-                    example_name = '/'.join(example_name.split('/')[:-1])
-                    res.append((example_name, headers))
-        return not is_failed, res
+        n_failed_example_sketches = 0
+        for s in sketches:
+            headers = Analyzer.get_headers_in_sketch(zipfile, s)
+            if headers is None:
+                n_failed_example_sketches += 1
+            else:
+                # To get the example sketch name with separating directories, first we preceding library archive
+                # name and the examples directory name.
+                example_name = s[s.find('/examples/') + len('/examples/'):]
+                # and then, omit the actual sketch source code name.
+                example_name = example_name.rpartition('/')[0]
+                res.append((example_name, headers))
+        return res, n_failed_example_sketches
 
     # NOTE: Currently the temporary directory is unused
     def prepare_temp_dir(self):
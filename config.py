@@ -1,4 +1,8 @@
-import toml
+import sys
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
 
 
 class MuninConfig:
@@ -9,8 +13,8 @@ class MuninConfig:
 
 
 def read_config(filename):
-    with open(filename) as f:
-        config_dict = toml.loads(f.read())
+    with open(filename, 'rb') as f:
+        config_dict = tomllib.load(f)
         return MuninConfig(
             config_dict['library_index_url'],
             config_dict['database_root'],
@@ -1,32 +1,70 @@
 import os
+import sys
+import collections
 from pathlib import Path
 import logging
 from urllib.parse import urlparse
 import datetime
-import copy
-import zipfile
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from zipfile import ZipFile, BadZipFile
 import re
-import toml
-import requests
-from progress.bar import Bar
+import hashlib
+import hmac
+import mmap
+import pickle
+import tomli_w
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
 import semver
 import library_index
+import util
+
+
+# Pattern for the source files of the example sketches. The first group is the name of the example.
+_RE_EXAMPLE_SOURCE = re.compile(r'^[^/]+/examples/((|.+/).+)/[^/]+[.](ino|pde|c|h|cpp|hpp|cxx|hxx|cc)$')
+
+
+# TOML has no null value, so remove the None values (e.g. the nulls of the JSON library index) from the data.
+def _drop_none_values(value):
+    if isinstance(value, dict):
+        return {k: _drop_none_values(v) for (k, v) in value.items() if v is not None}
+    if isinstance(value, list):
+        return [_drop_none_values(v) for v in value if v is not None]
+    return value
 
 
 class FeatureEntry:
     def __init__(self):
         self.examples = dict()
+        # The headers of each example as a frozenset for the subset tests on search
+        self.header_sets = dict()
 
+    # The header names are interned since the same names (e.g. 'Arduino.h') appear in many examples.
     def set_entry(self, name, headers):
-        self.examples[name] = list(headers)
+        self.examples[name] = tuple(sys.intern(h) for h in headers)
+        self.header_sets[name] = frozenset(self.examples[name])
 
 
 class FeatureDatabase:
     def __init__(self):
         self.libraries = dict()
+        # The examples grouped by their rarest header for the search, built on the first search.
+        # The values are lists of (position, other_headers, (name, version, example)) where other_headers is the
+        # frozenset of the headers of the example except the rarest one.
+        self.search_index = None
 
     def add_entry(self, name, version, example, headers):
+        self.add_entries(name, version, [(example, headers)])
+
+    # entries is a list of (example, headers) tuples for the same library version.
+    def add_entries(self, name, version, entries):
+        # Do not create an entry for the library without examples
+        if len(entries) == 0:
+            return
+
         if name not in self.libraries:
             self.libraries[name] = dict()
 
@@ -35,30 +73,57 @@ class FeatureDatabase:
             lib[version] = FeatureEntry()
 
         fe = lib[version]
-        fe.set_entry(example, headers)
+        for (example, headers) in entries:
+            fe.set_entry(example, headers)
+        self.search_index = None
+
+    # An example can only match a query containing all of its headers, in particular its rarest one (the header used
+    # by the fewest examples). So each example is put in the bucket of its rarest header, and a query only looks at
+    # the buckets of the headers in the query.
+    # The examples without headers never match, so they are left out of the index.
+    def build_search_index(self):
+        examples = []
+        for (name, variants) in self.libraries.items():
+            for (version, fe) in variants.items():
+                for (example_name, example_headers) in fe.header_sets.items():
+                    if len(example_headers) != 0:
+                        examples.append((example_headers, (name, version, example_name)))
+
+        header_count = collections.Counter()
+        for (example_headers, _) in examples:
+            header_count.update(example_headers)
+
+        index = dict()
+        # The position keeps the order of the results the same as that of the entries
+        for (position, (example_headers, key)) in enumerate(examples):
+            rarest = min(example_headers, key=lambda h: (header_count[h], h))
+            index.setdefault(rarest, []).append((position, example_headers - {rarest}, key))
+        return index
 
     def search_all_for_headers(self, headers):
+        if self.search_index is None:
+            self.search_index = self.build_search_index()
+        query = frozenset(headers)
         res = []
-        for (name, variants) in self.libraries.items():
-            for (version, fe) in variants.items():
-                for (example_name, example_headers) in fe.examples.items():
-                    if len(example_headers) != 0 and set(example_headers).issubset(set(headers)):
-                        res.append((name, version, example_name))
-        return res
+        for h in query:
+            # The rarest header is known to be in the query, so only the others are tested.
+            # The examples with a single header match without any test.
+            for (position, other_headers, key) in self.search_index.get(h, ()):
+                if not other_headers or other_headers <= query:
+                    res.append((position, key))
+        res.sort()
+        return [key for (_, key) in res]
 
     def serialize(self):
-        res = dict()
-        for (name, variants) in self.libraries.items():
-            if name not in res:
-                res[name] = dict()
-            for (version, fe) in variants.items():
-                if version not in res[name]:
-                    res[name][version] = dict()
-                for (example_name, example_headers) in fe.examples.items():
-                    if 'examples' not in res[name][version]:
-                        res[name][version]['examples'] = dict()
-                    res[name][version]['examples'][example_name] = list(example_headers)
-        return res
+        return {
+            name: {
+                version: {
+                    'examples': {
+                        example_name: list(example_headers) for (example_name, example_headers) in fe.examples.items()
+                    }
+                } for (version, fe) in variants.items()
+            } for (name, variants) in self.libraries.items()
+        }
 
     def deserialize(self, serialized):
         for (name, variants) in serialized.items():
@@ -72,32 +137,88 @@ class LibraryInfo:
         self.name = name
         self.version = version
         self.path = path
+        self.archive_path = None
+
+    # Returns the path of the library archive in the library directory.
+    def get_archive_path(self):
+        if self.archive_path is None:
+            self.archive_path = next(self.path.glob('*.zip'))
+        return self.archive_path
 
 
 class Database:
     LIBRARY_INDEX_FILENAME = 'library_index.toml'
     LIBRARY_STORAGE_DIRECTORY = 'libraries'
     LIBRARY_METADATA_FILENAME = 'meta.toml'
+    # An empty file present next to the metadata iff the library could be downloaded
+    LIBRARY_DOWNLOADED_FLAG_FILENAME = '.downloaded'
     HEADER_DICTIONARY_FILENAME = 'headers.toml'
     FEATURE_DATABASE_FILENAME = 'features.toml'
+    PARSE_CACHE_SUFFIX = '.cache.pkl'
+    # Unpickling can run arbitrary code, so the parse caches are signed with a key of the user and the caches that are
+    # not signed with it (e.g. in a database copied from someone else) are ignored.
+    # This is the default location of the key.
+    PARSE_CACHE_KEY_PATH = '~/.munin/parse_cache.key'
+    PARSE_CACHE_KEY_SIZE = 32
+    N_DOWNLOAD_THREADS = 16
+    N_DOWNLOAD_RETRIES = 3
+    # In seconds, for connecting and between the received data (not for the whole download)
+    DOWNLOAD_TIMEOUT = 30
+    DOWNLOAD_CHUNK_SIZE = 64 * 1024
+    DOWNLOAD_TEMP_SUFFIX = '.part'
+    WRITE_TEMP_SUFFIX = '.tmp'
+    EXTRACT_CHUNK_SIZE = 64 * 1024
 
     # Version specifiers for the extraction methods
     ALL_VERSIONS = 0
     LATEST_VERSIONS = 1
 
-    def __init__(self, directory):
+    # parse_cache_key_path is the file of the key to sign the parse caches with (created if it does not exist).
+    def __init__(self, directory, parse_cache_key_path=PARSE_CACHE_KEY_PATH):
         self.root_path = Path(directory).expanduser()
+        self.parse_cache_key_path = Path(parse_cache_key_path).expanduser()
         self.library_index = None
-        self.header_dict = {}
-        self.feature_data = FeatureDatabase()
+        self._header_dict = {}
+        self._feature_data = FeatureDatabase()
+        # The header dictionary and the feature database are read on the first access after load(), since many
+        # commands do not use them.
+        self.is_header_dict_pending = False
+        self.is_feature_data_pending = False
+        # The results of is_downloaded() by the library path
+        self.downloaded_cache = dict()
+        # The reverse of the header dictionary: the set of the headers by (name, version).
+        # This is built on the first removal and then kept up to date.
+        self.library_headers = None
+        # The key to sign the parse caches with, read on the first use (b'' if it is not available)
+        self.parse_cache_key = None
+
+    @property
+    def header_dict(self):
+        if self.is_header_dict_pending:
+            self.is_header_dict_pending = False
+            self.read_header_dictionary()
+        return self._header_dict
+
+    @header_dict.setter
+    def header_dict(self, header_dict):
+        self.is_header_dict_pending = False
+        self._header_dict = header_dict
+        self.library_headers = None
+
+    @property
+    def feature_data(self):
+        if self.is_feature_data_pending:
+            self.is_feature_data_pending = False
+            self.read_feature_database()
+        return self._feature_data
 
     def load(self, force=False):
         if self.library_index is None or force:
             self.library_index = self.read_library_index()
             if Path(self.root_path, self.HEADER_DICTIONARY_FILENAME).exists():
-                self.read_header_dictionary()
+                self.is_header_dict_pending = True
             if Path(self.root_path, self.FEATURE_DATABASE_FILENAME).exists():
-                self.read_feature_database()
+                self.is_feature_data_pending = True
 
     def save(self):
         if not self.library_index:
@@ -106,46 +227,64 @@ class Database:
         self.write_header_dictionary()
         self.write_feature_database()
 
-    def download(self, overwrite=False):
+    # session is the requests.Session to download with (a new one is created if not given).
+    def download(self, overwrite=False, session=None):
         if not self.library_index:
             raise ValueError('No library index. Cannot download packages.')
 
         self.secure_root_directory()
-        n_libs = len(self.library_index.libs)
-        print('Downloading {} library archives...'.format(n_libs))
-        bar = Bar('PROGRESS', max=n_libs)
-        for lib in self.library_index.libs:
-            name = lib['name']
-            version = lib['version']
-            url = lib['url']
-            self.download_library(name, version, url, overwrite)
-            bar.next()
-        bar.finish()
+        self.download_all(self.download_library, overwrite, session=session)
 
-    def restore(self):
+    def restore(self, session=None):
         if not self.library_index:
             raise ValueError('No library index. Cannot download packages.')
 
+        self.download_all(self.restore_library, session=session)
+
+    # Call download_function(name, version, url, *args, session) for all the libraries in the index.
+    # The downloads are network-bound, so run them in threads sharing the connection pool of a session.
+    def download_all(self, download_function, *args, session=None):
+        if session is None:
+            with self.create_session() as session:
+                self.download_all(download_function, *args, session=session)
+            return
+
         n_libs = len(self.library_index.libs)
         print('Downloading {} library archives...'.format(n_libs))
-        bar = Bar('PROGRESS', max=n_libs)
-        for lib in self.library_index.libs:
-            name = lib['name']
-            version = lib['version']
-            url = lib['url']
-            self.restore_library(name, version, url)
-            bar.next()
+        bar = util.BatchedBar('PROGRESS', max=n_libs)
+        with ThreadPoolExecutor(max_workers=self.N_DOWNLOAD_THREADS) as executor:
+            futures = []
+            for lib in self.library_index.libs:
+                name = lib['name']
+                version = lib['version']
+                url = lib['url']
+                futures.append(executor.submit(download_function, name, version, url, *args, session))
+            for future in as_completed(futures):
+                future.result()
+                bar.next()
         bar.finish()
 
+    # Create a session for downloading the library archives.
+    # The connection pool is sized for the download threads, and failed connections are retried.
+    def create_session(self):
+        # requests takes most of the startup time of Munin and only the download commands need it
+        import requests
+        from urllib3.util.retry import Retry
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.N_DOWNLOAD_THREADS,
+            pool_maxsize=self.N_DOWNLOAD_THREADS,
+            max_retries=Retry(total=self.N_DOWNLOAD_RETRIES, backoff_factor=0.5))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
     def search(self, header_name):
         res = []
         if header_name not in self.header_dict:
             return res
         libs = self.header_dict[header_name]
-        for lib in libs:
-            values = lib.split('\n')
-            name = values[0]
-            version = values[1]
+        for (name, version) in libs:
             res.append({'name': name, 'version': version})
         return res
 
@@ -165,47 +304,39 @@ class Database:
             info_list = []
             examples_list = []
             for e in examples:
-                # 'library_name\nversion'
                 (library_name, version, example_name) = e
-                temp_key = '\n'.join([library_name, version])
+                temp_key = (library_name, version)
                 if temp_key in temp_dict:
                     temp_dict[temp_key].append(example_name)
                 else:
                     temp_dict[temp_key] = [example_name]
             for (k, v) in temp_dict.items():
-                (library_name, version) = k.split('\n')
+                (library_name, version) = k
                 example_names = v
                 path = Path(self.root_path, self.LIBRARY_STORAGE_DIRECTORY, library_name, version)
                 if self.is_downloaded(path):
                     info_list.append(LibraryInfo(library_name, version, path))
                     examples_list.append(example_names)
 
-        # If the version_flag is set, remove unnecessary versions.
+        if examples_list is None:
+            targets = [(info, None) for info in info_list]
+        else:
+            targets = list(zip(info_list, examples_list))
+        if version_flag == Database.ALL_VERSIONS:
+            return targets
+        if version_flag != Database.LATEST_VERSIONS:
+            raise ValueError('BUG: Invalid version flag.')
+
+        # Remove all but the latest version of each library (the first one found if some versions are equal).
+        # Each version string is parsed only once.
         max_version = {}
-        variant_bucket = {}
-        if version_flag != Database.ALL_VERSIONS:
-            for i in range(len(info_list)):
-                info = info_list[i]
-                if examples_list is not None:
-                    ex = examples_list[i]
-                else:
-                    ex = None
-
-                if info.name in variant_bucket:
-                    if version_flag == Database.LATEST_VERSIONS:
-                        cmp_res = semver.compare(max_version[info.name], info.version) < 0
-                    else:
-                        raise ValueError('BUG: Invalid version flag.')
-                    if cmp_res:
-                        max_version[info.name] = info.version
-                        variant_bucket[info.name] = [(info, ex)]
-                else:
-                    max_version[info.name] = info.version
-                    variant_bucket[info.name] = [(info, ex)]
-        extract_targets = []
-        for v in variant_bucket.values():
-            extract_targets.extend(v)
-        return extract_targets
+        latest_targets = {}
+        for (info, ex) in targets:
+            version = semver.Version.parse(info.version)
+            if info.name not in max_version or max_version[info.name] < version:
+                max_version[info.name] = version
+                latest_targets[info.name] = (info, ex)
+        return list(latest_targets.values())
 
     # Returns the list of ([example_source_path,...], library_name, library_version, archive_path, archive_root)
     # or None on failure
@@ -215,9 +346,8 @@ class Database:
         for ex in targets:
             name = ex[0].name
             version = ex[0].version
-            library_storage_location = ex[0].path
             examples = ex[1]
-            ar = list(library_storage_location.glob('*.zip'))[0]
+            ar = ex[0].get_archive_path()
             try:
                 z = ZipFile(ar)
             except BadZipFile as ex:
@@ -225,36 +355,20 @@ class Database:
                 logging.error('Description: {}'.format(str(ex.args[0])))
                 return
             with z:
+                filenames = z.namelist()
                 # Locate the root directory of the library (NOT the root directory of the ZIP archive!)
-                # Note that the name of the root directory in Python zipfile module is a empty string.
-                archive_root = None
-                for p in z.namelist():
-                    item_path = zipfile.Path(z, p)
-                    if item_path.name != '' \
-                            and item_path.is_dir() \
-                            and item_path.parent.name == '':
-                        if archive_root is not None:
-                            logging.warning(
-                                'Multiple directories found in the root directory. Ignoring those found later.')
-                        else:
-                            archive_root = item_path.name
-                if archive_root is None:
+                # It is the first path component of the entries in a directory.
+                roots = dict.fromkeys(p.partition('/')[0] for p in filenames if '/' in p)
+                if len(roots) == 0:
                     logging.error('No directories found on the root directory.')
                     return None
+                if len(roots) > 1:
+                    logging.warning('Multiple directories found in the root directory. Ignoring those found later.')
+                archive_root = next(iter(roots))
                 # Extract all the example sources
-                filenames = z.namelist()
                 example_sources = []
-                for f in filenames:
-                    m = re.fullmatch(r'^[^/]+/examples/((|.+/).+)/[^/]+[.](ino|pde|c|h|cpp|hpp|cxx|hxx|cc)$', f)
-                    if m:
-                        logging.debug('Found a source code: {}'.format(f))
-                        found_example_name = m.group(1)
-                        if examples is not None:
-                            # Ignore example sources that is not specified with the argument.
-                            if found_example_name not in examples:
-                                continue
-                        # Below is executed if the found example is one of the specified ones, or none is specified.
-                        example_sources.append(str(os.path.relpath(Path(f), start=Path(archive_root, 'examples'))))
+                for (f, _) in self.find_example_sources(filenames, examples):
+                    example_sources.append(str(os.path.relpath(Path(f), start=Path(archive_root, 'examples'))))
                 res.append((
                     example_sources,
                     name,
@@ -267,26 +381,25 @@ class Database:
     def extract_example_sketches(self, output_path, examples=None, version_flag=ALL_VERSIONS):
         extract_targets = self.compute_extract_targets(examples, version_flag)
 
-        for (info, ex) in extract_targets:
-            if ex is None:
-                self.extract_examples_from_library(output_path, info)
-            else:
-                self.extract_examples_from_library(output_path, info, examples=ex)
-
-    def extract_examples_from_library(self, output_path, info, examples=None):
-        dataset_output_path = Path(output_path)
-        if not dataset_output_path.exists():
-            logging.debug('The library storage directory is not present. Creating one...')
-            dataset_output_path.mkdir(0o755)
-        target_library_path = Path(dataset_output_path, info.name)
-        if not target_library_path.exists():
-            logging.debug('The directory for the library is not present. Creating one...')
-            target_library_path.mkdir(0o755)
-        target_version_path = Path(target_library_path, info.version)
-        if not target_version_path.exists():
-            logging.debug('The directory for the version of the library is not present. Creating one...')
-            target_version_path.mkdir(0o755)
-        ar = list(info.path.glob('*.zip'))[0]
+        # The libraries are extracted in separate processes, as decompressing is CPU-bound.
+        if len(extract_targets) < 2:
+            for (info, ex) in extract_targets:
+                Database.extract_examples_from_library(output_path, info, examples=ex)
+        else:
+            with ProcessPoolExecutor(initializer=util.init_worker_logging,
+                                     initargs=util.get_worker_logging_config()) as executor:
+                futures = [executor.submit(Database.extract_examples_from_library, output_path, info, ex)
+                           for (info, ex) in extract_targets]
+                for future in futures:
+                    future.result()
+
+    # This runs in the worker processes of extract_example_sketches, so other workers may create the shared
+    # directories at the same time.
+    @staticmethod
+    def extract_examples_from_library(output_path, info, examples=None):
+        target_version_path = Path(output_path, info.name, info.version)
+        target_version_path.mkdir(0o755, parents=True, exist_ok=True)
+        ar = info.get_archive_path()
         try:
             z = ZipFile(ar)
         except BadZipFile as ex:
@@ -295,60 +408,101 @@ class Database:
             return
         with z:
             # Extract all the example sources
-            filenames = z.namelist()
-            for f in filenames:
-                m = re.fullmatch(r'^[^/]+/examples/((|.+/).+)/[^/]+[.](ino|pde|c|h|cpp|hpp|cxx|hxx|cc)$', f)
-                if m:
-                    logging.debug('Found a source code: {}'.format(f))
-                    found_example_name = m.group(1)
-                    if examples is not None:
-                        # Ignore example sources that is not specified with the argument.
-                        if found_example_name not in examples:
-                            continue
-                    # Below is executed if the found example is one of the specified ones, or none is specified.
-                    target_source_path = Path(target_version_path, found_example_name)
-                    if not target_source_path.exists():
-                        logging.debug('The directory for the source code is not present. Creating one...')
-                        target_source_path.mkdir(0o755, parents=True)
-                    content = z.read(f)
-                    with open(Path(target_source_path, Path(f).name), 'wb') as fo:
-                        fo.write(content)
+            created_paths = set()
+            for (f, found_example_name) in Database.find_example_sources(z.namelist(), examples):
+                target_source_path = Path(target_version_path, found_example_name)
+                if target_source_path not in created_paths:
+                    target_source_path.mkdir(0o755, parents=True, exist_ok=True)
+                    created_paths.add(target_source_path)
+                with z.open(f) as fi, open(Path(target_source_path, f.rsplit('/', 1)[-1]), 'wb') as fo:
+                    shutil.copyfileobj(fi, fo, Database.EXTRACT_CHUNK_SIZE)
+
+    # Returns the list of (filename, example_name) for the source files of the examples in the archive entries.
+    # If examples is not None, only the sources of the examples in it are returned.
+    @staticmethod
+    def find_example_sources(filenames, examples=None):
+        if examples is not None:
+            examples = set(examples)
+        res = []
+        for f in filenames:
+            m = _RE_EXAMPLE_SOURCE.fullmatch(f)
+            if m:
+                logging.debug('Found a source code: {}'.format(f))
+                found_example_name = m.group(1)
+                # Ignore example sources that is not specified with the argument.
+                if examples is None or found_example_name in examples:
+                    res.append((f, found_example_name))
+        return res
 
     def search_example_sketches(self, headers):
         return self.feature_data.search_all_for_headers(headers)
 
     def get_library_info_list(self):
         info_list = []
+        lib_storage_path = Path(self.root_path, self.LIBRARY_STORAGE_DIRECTORY)
         for lib in self.library_index.libs:
             name = lib['name']
             version = lib['version']
-            path = Path(self.root_path, self.LIBRARY_STORAGE_DIRECTORY, name, version)
+            path = Path(lib_storage_path, name, version)
             # Append the library data if the archive exists locally
             if self.is_downloaded(path):
                 info_list.append(LibraryInfo(name, version, path))
         return info_list
 
-    # For the entries of the set of libraries, we use the name and the version as strings concatenated by '\n'.
-    # This makes the library information serializable, which is not the case if we use the dictionary.
+    # For the entries of the set of libraries, we use (name, version) tuples.
+    # This makes the library information hashable, which is not the case if we use the dictionary.
     def add_header_dictionary_entry(self, lib_info, headers):
+        lib = (lib_info.name, lib_info.version)
+        header_dict = self.header_dict
+        added_headers = []
         for h in headers:
-            h = str(h)
-            if h in self.header_dict:
+            h = sys.intern(str(h))
+            added_headers.append(h)
+            if h in header_dict:
                 # Add a library candidate if not yet added
-                self.header_dict[h].add('{}\n{}'.format(lib_info.name, lib_info.version))
+                header_dict[h].add(lib)
             else:
                 # Create a new set of candidates for the header file
-                self.header_dict[h] = {'{}\n{}'.format(lib_info.name, lib_info.version)}
+                header_dict[h] = {lib}
+        if self.library_headers is not None:
+            self.library_headers.setdefault(lib, set()).update(added_headers)
+
+    # Remove the library from the candidates of all its headers, e.g. before adding the new analysis result.
+    def remove_header_dictionary_entries(self, lib_info):
+        header_dict = self.header_dict
+        if self.library_headers is None:
+            self.library_headers = dict()
+            for (h, libs) in header_dict.items():
+                for lib in libs:
+                    self.library_headers.setdefault(lib, set()).add(h)
+        for h in self.library_headers.pop((lib_info.name, lib_info.version), ()):
+            libs = header_dict[h]
+            libs.discard((lib_info.name, lib_info.version))
+            if len(libs) == 0:
+                del header_dict[h]
 
     def add_feature_database_entry(self, lib_info, example_name, headers):
         self.feature_data.add_entry(lib_info.name, lib_info.version, example_name, headers)
 
+    # entries is a list of (example_name, headers) tuples for the library.
+    def add_feature_database_entries(self, lib_info, entries):
+        self.feature_data.add_entries(lib_info.name, lib_info.version, entries)
+
     def is_downloaded(self, library_path):
+        library_path = Path(library_path)
+        if library_path not in self.downloaded_cache:
+            self.downloaded_cache[library_path] = self.read_downloaded_flag(library_path)
+        return self.downloaded_cache[library_path]
+
+    def read_downloaded_flag(self, library_path):
+        # Avoid parsing the metadata for the downloaded libraries
+        if Path(library_path, self.LIBRARY_DOWNLOADED_FLAG_FILENAME).exists():
+            return True
+        # The flag is not present for failed downloads or in the databases created without it
         meta_path = Path(library_path, self.LIBRARY_METADATA_FILENAME)
         if meta_path.exists():
-            with open(meta_path) as f:
-                toml_string = f.read()
-                metadata = toml.loads(toml_string)
+            with open(meta_path, 'rb') as f:
+                metadata = tomllib.load(f)
                 return metadata['could_download']
         else:
             return False
@@ -357,12 +511,9 @@ class Database:
         res = {}
         for (k, v) in self.header_dict.items():
             libs = []
-            for lib in v:
-                values = lib.split('\n')
-                name = values[0]
-                version = values[1]
+            for (name, version) in v:
                 libs.append({'name': name, 'version': version})
-            res[k] = copy.deepcopy(libs)
+            res[k] = libs
 
         return res
 
@@ -371,111 +522,213 @@ class Database:
         for (k, v) in dict_from_toml.items():
             libs = set()
             for lib in v:
-                lib_str = '{}\n{}'.format(lib['name'], lib['version'])
-                libs.add(lib_str)
-            res[k] = copy.deepcopy(libs)
+                libs.add((lib['name'], lib['version']))
+            res[sys.intern(k)] = libs
 
         return res
 
     def secure_root_directory(self):
-        if not self.root_path.exists():
-            logging.debug('The root directory for the database does not exist. Creating one...')
-            self.root_path.mkdir(0o755)
+        self.root_path.mkdir(0o755, parents=True, exist_ok=True)
 
     def write_library_index(self, index):
         self.secure_root_directory()
-        with open(os.path.join(self.root_path, self.LIBRARY_INDEX_FILENAME), 'w') as f:
-            toml_string = toml.dumps(index.__dict__)
-            f.write(toml_string)
+        # Parsing the large index takes seconds, so write its parse cache as well. tomli_w is used because the data it
+        # writes is parsed back exactly (which is not always the case with toml).
+        data_dict = _drop_none_values(index.__dict__)
+        self.write_toml_cached(Path(self.root_path, self.LIBRARY_INDEX_FILENAME), data_dict, dumps=tomli_w.dumps)
+
+    # Returns None if the database does not have a library index yet, or if it cannot be read (e.g. the index written
+    # by the older versions with an invalid escape), since the index is then just downloaded again.
+    def read_existing_library_index(self):
+        index_path = Path(self.root_path, self.LIBRARY_INDEX_FILENAME)
+        if not index_path.exists():
+            return None
+        try:
+            return self.read_library_index()
+        except (OSError, ValueError) as e:
+            logging.warning('Ignoring the unreadable library index: {} ({})'.format(index_path, e))
+            return None
 
     def read_library_index(self):
-        with open(os.path.join(self.root_path, self.LIBRARY_INDEX_FILENAME)) as f:
-            toml_string = f.read()
-            index_dict = toml.loads(toml_string)
-            return library_index.from_database_toml_dict(index_dict)
+        index_dict = self.read_toml_cached(Path(self.root_path, self.LIBRARY_INDEX_FILENAME))
+        return library_index.from_database_toml_dict(index_dict)
 
     def write_header_dictionary(self):
+        # The file is up to date if it has not been read
+        if self.is_header_dict_pending:
+            return
         self.secure_root_directory()
         data_dict = self.serialize_header_dictionary()
-        toml_string = toml.dumps(data_dict)
-        with open(Path(self.root_path, self.HEADER_DICTIONARY_FILENAME), 'w') as f:
-            f.write(toml_string)
+        self.write_toml_cached(Path(self.root_path, self.HEADER_DICTIONARY_FILENAME), data_dict)
 
     def read_header_dictionary(self):
-        with open(Path(self.root_path, self.HEADER_DICTIONARY_FILENAME)) as f:
-            toml_string = f.read()
-            data_dict = toml.loads(toml_string)
-            self.header_dict = self.deserialize_header_dictionary(data_dict)
+        data_dict = self.read_toml_cached(Path(self.root_path, self.HEADER_DICTIONARY_FILENAME))
+        self.header_dict = self.deserialize_header_dictionary(data_dict)
 
     def write_feature_database(self):
+        # The file is up to date if it has not been read
+        if self.is_feature_data_pending:
+            return
         self.secure_root_directory()
         data_dict = self.feature_data.serialize()
-        toml_string = toml.dumps(data_dict)
-        with open(Path(self.root_path, self.FEATURE_DATABASE_FILENAME), 'w') as f:
-            f.write(toml_string)
+        self.write_toml_cached(Path(self.root_path, self.FEATURE_DATABASE_FILENAME), data_dict)
 
     def read_feature_database(self):
-        with open(Path(self.root_path, self.FEATURE_DATABASE_FILENAME)) as f:
-            toml_string = f.read()
-            data_dict = toml.loads(toml_string)
-            self.feature_data.deserialize(data_dict)
-
-    def download_library(self, name, version, url, overwrite=False):
+        data_dict = self.read_toml_cached(Path(self.root_path, self.FEATURE_DATABASE_FILENAME))
+        self.feature_data.deserialize(data_dict)
+
+    # Parse the TOML file with a cache of the parsed data.
+    # The data is pickled next to the TOML file with the SHA-256 digest of the file, so the TOML parsing is skipped
+    # until the file is modified.
+    def read_toml_cached(self, path):
+        with open(path, 'rb') as f:
+            # Map the file instead of reading it so that it is not copied when the cache is valid
+            # (an empty file cannot be mapped)
+            if os.fstat(f.fileno()).st_size == 0:
+                return self.parse_toml_cached(path, b'')
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return self.parse_toml_cached(path, data)
+
+    # data is the content of the TOML file at path as a bytes-like object.
+    def parse_toml_cached(self, path, data):
+        digest = hashlib.sha256(data).digest()
+        cache_path = self.get_parse_cache_path(path)
+        key = self.get_parse_cache_key()
+        if key is not None and cache_path.exists():
+            try:
+                with open(cache_path, 'rb') as f:
+                    signed_data = f.read()
+                # The HMAC-SHA256 signature is followed by the pickle
+                (signature, cache_data) = (signed_data[:32], signed_data[32:])
+                if hmac.compare_digest(signature, hmac.digest(key, cache_data, 'sha256')):
+                    (cached_digest, cached_data) = pickle.loads(cache_data)
+                    if cached_digest == digest:
+                        return cached_data
+                else:
+                    logging.info('Ignoring the parse cache not signed with the key of this user: {}'.format(cache_path))
+            except (OSError, EOFError, TypeError, ValueError, pickle.UnpicklingError):
+                logging.debug('Ignoring the broken parse cache: {}'.format(cache_path))
+
+        data_dict = tomllib.loads(str(data, 'utf-8'))
+        self.write_parse_cache(cache_path, digest, data_dict)
+        return data_dict
+
+    # Write the data as a TOML file and its parse cache for read_toml_cached, so that the next load does not parse
+    # the file written here.
+    # Use this only for the data that TOML represents as is (e.g. tomli_w refuses None values).
+    # dumps is the function to encode the data into a TOML string. Its output must parse back into data_dict, or the
+    # parse cache hides a broken file (tomli_w does this; toml does not always escape the strings correctly).
+    def write_toml_cached(self, path, data_dict, dumps=tomli_w.dumps):
+        data = dumps(data_dict).encode('utf-8')
+        self.write_file_atomically(path, data)
+        self.write_parse_cache(self.get_parse_cache_path(path), hashlib.sha256(data).digest(), data_dict)
+
+    def get_parse_cache_path(self, path):
+        return Path(path.parent, path.name + self.PARSE_CACHE_SUFFIX)
+
+    def write_parse_cache(self, cache_path, digest, data_dict):
+        key = self.get_parse_cache_key()
+        if key is None:
+            return
+        data = pickle.dumps((digest, data_dict), protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            self.write_file_atomically(cache_path, hmac.digest(key, data, 'sha256') + data)
+        except OSError:
+            logging.warning('Could not write the parse cache: {}'.format(cache_path))
+
+    # Returns the key to sign the parse caches with, or None if it is not available (then the caches are not used).
+    def get_parse_cache_key(self):
+        if self.parse_cache_key is None:
+            self.parse_cache_key = self.read_parse_cache_key()
+        return self.parse_cache_key if len(self.parse_cache_key) > 0 else None
+
+    # The key is created on the first run, readable only by the user.
+    def read_parse_cache_key(self):
+        key_path = self.parse_cache_key_path
+        try:
+            key_path.parent.mkdir(0o700, parents=True, exist_ok=True)
+            try:
+                fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o600)
+            except FileExistsError:
+                key = key_path.read_bytes()
+            else:
+                key = os.urandom(self.PARSE_CACHE_KEY_SIZE)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(key)
+        except OSError as e:
+            logging.warning('Could not read the parse cache key, parse caches are disabled: {} ({})'.format(key_path, e))
+            return b''
+        if len(key) != self.PARSE_CACHE_KEY_SIZE:
+            logging.warning('Invalid parse cache key, parse caches are disabled: {}'.format(key_path))
+            return b''
+        return key
+
+    # Write the data (bytes) into a temporary file and then rename it to path, so that the file at path is always
+    # either the old one or the complete new one even if the process is interrupted.
+    def write_file_atomically(self, path, data):
+        temp_path = Path(path.parent, path.name + self.WRITE_TEMP_SUFFIX)
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        temp_path.replace(path)
+
+    # session is the requests.Session to download with (if any).
+    def download_library(self, name, version, url, overwrite=False, session=None):
         # Create needed directories if they are not present
-        lib_storage_path = Path(self.root_path, self.LIBRARY_STORAGE_DIRECTORY)
-        if not lib_storage_path.exists():
-            logging.debug('The library storage directory is not present. Creating one...')
-            lib_storage_path.mkdir(0o755)
-        target_library_path = Path(lib_storage_path, name)
-        if not target_library_path.exists():
-            logging.debug('The directory for the library is not present. Creating one...')
-            target_library_path.mkdir(0o755)
-        target_version_path = Path(target_library_path, version)
-        if not target_version_path.exists():
-            logging.debug('The directory for the version of the library is not present. Creating one...')
-            target_version_path.mkdir(0o755)
-
-        archives = list(target_version_path.glob('*.zip'))
+        # (other download threads may create the shared parent directories at the same time)
+        target_version_path = Path(self.root_path, self.LIBRARY_STORAGE_DIRECTORY, name, version)
+        target_version_path.mkdir(0o755, parents=True, exist_ok=True)
+
+        with os.scandir(target_version_path) as it:
+            archives = [entry.path for entry in it if entry.name.endswith('.zip')]
         if not overwrite and len(archives) > 0:
             logging.debug('Some archives already exist. Skipping download.')
             return
 
         # Replace the content with the new archives
         for ar in archives:
-            ar.unlink()
-        archive_filename = urlparse(url).path.split('/')[-1]
-        r = requests.get(url)
-        dt = datetime.datetime.now(datetime.timezone.utc)
-        if r.status_code != 200:
-            logging.error('Unexpected HTTP status code: {}'.format(r.status_code))
-            self.write_library_metadata(target_version_path, dt, False)
-            logging.error('Could not download a library at: {}'.format(url))
-        else:
-            with open(Path(target_version_path, archive_filename), 'wb') as f:
-                f.write(r.content)
-                self.write_library_metadata(target_version_path, dt, True)
+            os.unlink(ar)
+        self.fetch_library_archive(target_version_path, url, session)
 
     # Restore missing library archives and update the library metadata.
-    def restore_library(self, name, version, url):
-        lib_storage_path = Path(self.root_path, self.LIBRARY_STORAGE_DIRECTORY)
-        target_library_path = Path(lib_storage_path, name)
-        target_version_path = Path(target_library_path, version)
+    def restore_library(self, name, version, url, session=None):
+        target_version_path = Path(self.root_path, self.LIBRARY_STORAGE_DIRECTORY, name, version)
+        target_version_path.mkdir(0o755, parents=True, exist_ok=True)
         if self.is_downloaded(target_version_path):
             logging.info('The library archive in path: {} appears to be downloaded in the original Munin database. Restoring...')
+        self.fetch_library_archive(target_version_path, url, session)
+
+    # Download the library archive at url into library_path and write the library metadata.
+    # The response body is streamed into a temporary file which is renamed after the download completes, so that an
+    # interrupted download does not leave a truncated archive behind.
+    def fetch_library_archive(self, library_path, url, session=None):
         archive_filename = urlparse(url).path.split('/')[-1]
-        r = requests.get(url)
-        dt = datetime.datetime.now(datetime.timezone.utc)
-        if r.status_code != 200:
-            logging.error('Unexpected HTTP status code: {}'.format(r.status_code))
-            self.write_library_metadata(target_version_path, dt, False)
-            logging.error('Could not download a library at: {}'.format(url))
+        if session is not None:
+            r = session.get(url, stream=True, timeout=self.DOWNLOAD_TIMEOUT)
         else:
-            with open(Path(target_version_path, archive_filename), 'wb') as f:
-                f.write(r.content)
-                self.write_library_metadata(target_version_path, dt, True)
+            import requests
+            r = requests.get(url, stream=True, timeout=self.DOWNLOAD_TIMEOUT)
+        with r:
+            dt = datetime.datetime.now(datetime.timezone.utc)
+            if r.status_code != 200:
+                logging.error('Unexpected HTTP status code: {}'.format(r.status_code))
+                self.write_library_metadata(library_path, dt, False)
+                logging.error('Could not download a library at: {}'.format(url))
+            else:
+                archive_path = Path(library_path, archive_filename)
+                temp_path = Path(library_path, archive_filename + self.DOWNLOAD_TEMP_SUFFIX)
+                with open(temp_path, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=self.DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                temp_path.replace(archive_path)
+                self.write_library_metadata(library_path, dt, True)
 
     def write_library_metadata(self, library_path, access_date, could_download):
         metadata_dict = {'access_date': access_date, 'could_download': could_download}
-        toml_string = toml.dumps(metadata_dict)
-        with open(Path(library_path, self.LIBRARY_METADATA_FILENAME), 'w') as f:
-            f.write(toml_string)
+        toml_string = tomli_w.dumps(metadata_dict)
+        self.write_file_atomically(Path(library_path, self.LIBRARY_METADATA_FILENAME), toml_string.encode('utf-8'))
+        flag_path = Path(library_path, self.LIBRARY_DOWNLOADED_FLAG_FILENAME)
+        if could_download:
+            flag_path.touch()
+        elif flag_path.exists():
+            flag_path.unlink()
+        self.downloaded_cache.pop(Path(library_path), None)
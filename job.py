@@ -130,9 +130,10 @@ class HuginSession:
             toml_string = toml.dumps(self.session.serialize())
             f.write(toml_string)
         shutil.copytree(self.project_root, self.output_path.joinpath(self.project_root.name))
+        jobs_path = self.output_path.joinpath(HuginSession.HUGIN_JOBS_PATH)
         for (i, j) in enumerate(self.jobs):
             file_name = HuginSession.JOB_FILE_PREFIX + str(i) + '.toml'
-            with open(self.output_path.joinpath(HuginSession.HUGIN_JOBS_PATH).joinpath(file_name), 'w') as f:
+            with open(jobs_path.joinpath(file_name), 'w') as f:
                 toml_string = toml.dumps(j.serialize())
                 f.write(toml_string)
 
@@ -5,10 +5,26 @@ class LibraryIndex:
     def __init__(self, libs):
         self.libs = libs
         self.access_date = datetime.datetime.now(datetime.timezone.utc)
+        # The ETag and Last-Modified response headers of the index (None if not sent)
+        self.etag = None
+        self.last_modified = None
 
     def set_access_date(self, dt):
         self.access_date = dt
 
+    def set_cache_validators(self, etag, last_modified):
+        self.etag = etag
+        self.last_modified = last_modified
+
+    # Request headers to download the index only if it was modified since this one.
+    def get_conditional_request_headers(self):
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
 
 def from_json_dict(d):
     if 'libraries' not in d:
@@ -29,4 +45,6 @@ def from_database_toml_dict(d):
 
     res = LibraryIndex(d['libs'])
     res.set_access_date(d['access_date'])
+    # Indexes written by older versions do not have the validators
+    res.set_cache_validators(d.get('etag'), d.get('last_modified'))
     return res
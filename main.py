@@ -2,12 +2,11 @@
 # 2020-2021 C ikubaku <hide4d51 at gmail.com>
 # This program is licensed under The MIT License
 
+import os
 import sys
 import argparse
 import logging
 import datetime
-import requests
-import shutil
 from pathlib import Path
 import toml
 import config
@@ -66,33 +65,46 @@ def do_find_headers(conf):
 
 
 def do_fetch(conf, populate=False):
-    # Download the library index
-    logging.info('Downloading the package index from: {}...'.format(conf.library_index_url))
-    r = requests.get(conf.library_index_url)
-    if r.status_code != 200:
-        logging.error('Unexpected HTTP status code {} (expected 200).'.format(r.status_code))
-        return -1
-    index_access_date = datetime.datetime.now(datetime.timezone.utc)
-    logging.info('Downloaded the index at: {}'.format(index_access_date))
-
-    # Parse the library index
-    logging.info('Parsing the library index...')
-    try:
-        index_json_dict = r.json()
-    except ValueError:
-        logging.error('The response does not contain valid JSON data.')
-        return -1
-    index = library_index.from_json_dict(index_json_dict)
-    index.set_access_date(index_access_date)
-
     # Open and / or create the database
     logging.info('Opening the database...')
     db = database.Database(conf.database_root)
 
-    # Fetch library archives and overwrite local data
-    logging.info('Fetching library archives...')
-    db.library_index = index
-    db.download(overwrite=populate)
+    # Reuse the previous index if the server reports that it is not modified
+    previous_index = db.read_existing_library_index()
+    if previous_index is not None:
+        request_headers = previous_index.get_conditional_request_headers()
+    else:
+        request_headers = {}
+
+    # Share the connections between the index and the archive downloads
+    with db.create_session() as session:
+        # Download the library index
+        logging.info('Downloading the package index from: {}...'.format(conf.library_index_url))
+        r = session.get(conf.library_index_url, headers=request_headers, timeout=db.DOWNLOAD_TIMEOUT)
+        if r.status_code == 304 and previous_index is not None:
+            logging.info('The library index is not modified since the last fetch.')
+            index = previous_index
+        elif r.status_code != 200:
+            logging.error('Unexpected HTTP status code {} (expected 200).'.format(r.status_code))
+            return -1
+        else:
+            # Parse the library index
+            logging.info('Parsing the library index...')
+            try:
+                index_json_dict = r.json()
+            except ValueError:
+                logging.error('The response does not contain valid JSON data.')
+                return -1
+            index = library_index.from_json_dict(index_json_dict)
+            index.set_cache_validators(r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        index_access_date = datetime.datetime.now(datetime.timezone.utc)
+        logging.info('Downloaded the index at: {}'.format(index_access_date))
+        index.set_access_date(index_access_date)
+
+        # Fetch library archives and overwrite local data
+        logging.info('Fetching library archives...')
+        db.library_index = index
+        db.download(overwrite=populate, session=session)
 
     # Save other important data
     logging.info('Saving additional data...')
@@ -166,6 +178,27 @@ def do_extract(conf, output_path, extract_latest, sketch=None):
             return 0
 
 
+# Returns (sketches, files) of the project in a single pass over its directory.
+# The sketches are the .ino files, or the .pde files if the project has no .ino file.
+def scan_project(project_root):
+    ino_sketches = []
+    pde_sketches = []
+    files = []
+    with os.scandir(project_root) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            p = Path(entry.path)
+            files.append(p)
+            if entry.name.endswith('.ino'):
+                ino_sketches.append(p)
+            elif entry.name.endswith('.pde'):
+                pde_sketches.append(p)
+    if len(ino_sketches) == 0:
+        return pde_sketches, files
+    return ino_sketches, files
+
+
 def do_gen_session(conf, project_path, output_path, narrow, extract_latest, sketch_only):
     # Open the database
     logging.info('Opening the database...')
@@ -174,9 +207,7 @@ def do_gen_session(conf, project_path, output_path, narrow, extract_latest, sket
     logging.info('Generating the Hugin session...')
     hugin_session = job.HuginSession(output_path)
     hugin_session.set_project_root(project_path)
-    sketches = list(project_path.expanduser().glob("*.ino"))
-    if len(sketches) == 0:
-        sketches = list(project_path.expanduser().glob("*.pde"))
+    (sketches, project_files) = scan_project(project_path.expanduser())
     if len(sketches) == 0:
         logging.error('No sketch found in the specified project.')
         return -1
@@ -207,13 +238,6 @@ def do_gen_session(conf, project_path, output_path, narrow, extract_latest, sket
 
     if sketch_only:
         project_files = [sketches[0]]
-    else:
-        project_ls = project_path.expanduser().iterdir()
-        project_files = []
-        for p in project_ls:
-            if not p.is_file():
-                continue
-            project_files.append(p)
     for (example_sources, library_name, library_version, archive_path, archive_root) in res:
         for s in example_sources:
             for p in project_files:
@@ -407,13 +431,11 @@ def main():
 
     args = parser.parse_args()
 
-    args.func(args)
-
-    try:
-        args.func(args)
-    except AttributeError:
+    # Only the subcommands set func
+    if not hasattr(args, 'func'):
         print('Bad command is specified or the command is empty.')
         sys.exit(-1)
+    args.func(args)
 
 
 # Press the green button in the gutter to run the script.
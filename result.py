@@ -8,6 +8,9 @@ from job import SourceInfo, JobLibraryInfo
 
 
 class CodePosition:
+    # There are several of these objects for each clone pair, so they do not have a __dict__
+    __slots__ = ('lines', 'columns')
+
     def __init__(self, lines, columns):
         self.lines = lines
         self.columns = columns
@@ -17,7 +20,22 @@ class CodePosition:
         return CodePosition(serialized['lines'], serialized['columns'])
 
 
+# The source code (str or bytes) split into the lines.
+# The clone pairs of a result are all sliced from the same sources, so the sources are split only once.
+class SourceLines:
+    __slots__ = ('lines', 'nl')
+
+    def __init__(self, code_string):
+        self.lines = code_string.splitlines()
+        if isinstance(code_string, bytes):
+            self.nl = b'\n'
+        else:
+            self.nl = '\n'
+
+
 class CodeSlice:
+    __slots__ = ('start', 'end')
+
     def __init__(self, start, end):
         self.start = start
         self.end = end
@@ -30,25 +48,24 @@ class CodeSlice:
         )
 
     def get_code_from(self, code_string):
-        if isinstance(code_string, bytes):
-            nl = b'\n'
-            res = b''
-        else:
-            nl = '\n'
-            res = ''
-        lines = code_string.splitlines()[self.start.lines-1:self.end.lines-1+1]
-        res += lines[0][self.start.columns-1:] + nl
+        return self.get_code_from_lines(SourceLines(code_string))
+
+    def get_code_from_lines(self, source_lines):
+        nl = source_lines.nl
+        lines = source_lines.lines[self.start.lines-1:self.end.lines-1+1]
+        # Join the lines at once instead of concatenating the partial results
+        parts = [lines[0][self.start.columns-1:]]
         if len(lines) > 2:
-            res += nl.join(lines[1:-1]) + nl
-        res += lines[-1][:self.end.columns-1+1] + nl
-        return res
+            parts.extend(lines[1:-1])
+        parts.append(lines[-1][:self.end.columns-1+1])
+        return nl.join(parts) + nl
 
     def get_nearby_from(self, code_string, width=2):
-        if isinstance(code_string, bytes):
-            nl = b'\n'
-        else:
-            nl = '\n'
-        lines = code_string.splitlines()
+        return self.get_nearby_from_lines(SourceLines(code_string), width)
+
+    def get_nearby_from_lines(self, source_lines, width=2):
+        nl = source_lines.nl
+        lines = source_lines.lines
         start_lines = max(1, self.start.lines - width)
         end_lines = min(len(lines), self.end.lines + width)
         res = nl.join(lines[start_lines-1:end_lines-1]) + nl
@@ -56,6 +73,8 @@ class CodeSlice:
 
 
 class Scores:
+    __slots__ = ('project_part', 'example_sketch_part')
+
     def __init__(self, project_part, example_sketch_part):
         self.project_part = project_part
         self.example_sketch_part = example_sketch_part
@@ -66,6 +85,8 @@ class Scores:
 
 
 class ClonePair:
+    __slots__ = ('project', 'example_sketch', 'scores')
+
     def __init__(self, project, example_sketch, scores):
         self.project = project
         self.example_sketch = example_sketch
@@ -81,6 +102,8 @@ class ClonePair:
 
 
 class JobResult:
+    __slots__ = ('project', 'example_sketch', 'job_library_info', 'clone_pairs')
+
     def __init__(self, project, example_sketch, job_library_info, clone_pairs):
         self.project = project
         self.example_sketch = example_sketch
@@ -101,6 +124,10 @@ class ResultConverter:
         self.database_root_path = Path(database_root_path).expanduser()
         self.project_sketch_path = project_sketch_path.expanduser()
         self.results = None
+        # The split project source files by the filename
+        self.project_source_lines = {}
+        # The opened library archives by the archive path
+        self.archives = {}
 
     def load_results_from_serialized(self, serialized):
         results = serialized['results']
@@ -122,14 +149,30 @@ class ResultConverter:
                 'Library name: {}\n'.format(job_result.job_library_info.name),
                 'Library version: {}\n'.format(str(job_result.job_library_info.version)),
                 'Found pairs: {}\n'.format(len(job_result.clone_pairs))]
-        with open(filename, 'w') as f:
-            f.writelines(data)
+        Path(filename).write_text(''.join(data))
 
     def get_project_source_file_content(self, filename):
         with open(self.project_sketch_path.joinpath(filename)) as f:
             return f.read()
 
+    def get_project_source_file_lines(self, filename):
+        # Most of the results are for the same few project files
+        if filename not in self.project_source_lines:
+            self.project_source_lines[filename] = SourceLines(self.get_project_source_file_content(filename))
+        return self.project_source_lines[filename]
+
     def get_example_sketch_source_file_content(self, archive_path, archive_root_name, example_filename):
+        z = self.open_archive(archive_path)
+        if z is None:
+            return
+        source_filename = '{}/examples/{}'.format(archive_root_name, example_filename)
+        return z.read(source_filename)
+
+    # The results of a library share its archive, so the archives stay open until close_archives() is called.
+    # Returns None if the archive is missing or invalid (which is remembered as well, so it is reported once).
+    def open_archive(self, archive_path):
+        if archive_path in self.archives:
+            return self.archives[archive_path]
         try:
             z = ZipFile(
                 self.database_root_path
@@ -139,13 +182,21 @@ class ResultConverter:
         except BadZipFile as ex:
             logging.error('Invalid Zip archive: {}'.format(archive_path))
             logging.error('Description: {}'.format(str(ex.args[0])))
-            return
-        with z:
-            source_filename = '{}/examples/{}'.format(archive_root_name, example_filename)
-            return z.read(source_filename)
+            z = None
+        except OSError as ex:
+            logging.error('Could not open the archive: {} ({})'.format(archive_path, ex))
+            z = None
+        self.archives[archive_path] = z
+        return z
+
+    def close_archives(self):
+        for z in self.archives.values():
+            if z is not None:
+                z.close()
+        self.archives = {}
 
     @staticmethod
-    def extract_clone_pair_to(directory_path, clone_pair, project_source_content, example_sketch_source_content):
+    def extract_clone_pair_to(directory_path, clone_pair, project_source_lines, example_sketch_source_lines):
         data = ['Project:\n',
                 '    at: {}:{}\n'.format(clone_pair.project.start.lines, clone_pair.project.start.columns),
                 '    to: {}:{}\n'.format(clone_pair.project.end.lines, clone_pair.project.end.columns),
@@ -155,32 +206,27 @@ class ResultConverter:
                 '    at: {}:{}\n'.format(clone_pair.example_sketch.start.lines, clone_pair.example_sketch.start.columns),
                 '    to: {}:{}\n'.format(clone_pair.example_sketch.end.lines, clone_pair.example_sketch.end.columns),
                 '    score: {}\n'.format(clone_pair.scores.example_sketch_part)]
-        with open(directory_path.joinpath(ResultConverter.PAIR_INFO_FILE_NAME), 'w') as f:
-            f.writelines(data)
-        project_clone_code = clone_pair.project.get_code_from(project_source_content)
-        project_clone_nearby = clone_pair.project.get_nearby_from(project_source_content)
-        example_sketch_clone_code = clone_pair.example_sketch.get_code_from(example_sketch_source_content)
-        example_sketch_clone_nearby = clone_pair.example_sketch.get_nearby_from(example_sketch_source_content)
-        with open(directory_path.joinpath('{}_{}.txt'.format(
+        directory_path.joinpath(ResultConverter.PAIR_INFO_FILE_NAME).write_text(''.join(data))
+        project_clone_code = clone_pair.project.get_code_from_lines(project_source_lines)
+        project_clone_nearby = clone_pair.project.get_nearby_from_lines(project_source_lines)
+        example_sketch_clone_code = clone_pair.example_sketch.get_code_from_lines(example_sketch_source_lines)
+        example_sketch_clone_nearby = clone_pair.example_sketch.get_nearby_from_lines(example_sketch_source_lines)
+        directory_path.joinpath('{}_{}.txt'.format(
             ResultConverter.CLONE_PREFIX,
             ResultConverter.PROJECT_TAG_NAME
-        )), 'w') as f:
-            f.write(project_clone_code)
-        with open(directory_path.joinpath('{}_{}.txt'.format(
+        )).write_text(project_clone_code)
+        directory_path.joinpath('{}_{}.txt'.format(
             ResultConverter.NEARBY_PREFIX,
             ResultConverter.PROJECT_TAG_NAME
-        )), 'w') as f:
-            f.write(project_clone_nearby)
-        with open(directory_path.joinpath('{}_{}.txt'.format(
+        )).write_text(project_clone_nearby)
+        directory_path.joinpath('{}_{}.txt'.format(
             ResultConverter.CLONE_PREFIX,
             ResultConverter.EXAMPLE_SKETCH_TAG_NAME
-        )), 'wb') as f:
-            f.write(example_sketch_clone_code)
-        with open(directory_path.joinpath('{}_{}.txt'.format(
+        )).write_bytes(example_sketch_clone_code)
+        directory_path.joinpath('{}_{}.txt'.format(
             ResultConverter.NEARBY_PREFIX,
             ResultConverter.EXAMPLE_SKETCH_TAG_NAME
-        )), 'wb') as f:
-            f.write(example_sketch_clone_nearby)
+        )).write_bytes(example_sketch_clone_nearby)
 
     def generate_readable_results(self, output_path):
         output_path = output_path.expanduser()
@@ -188,29 +234,36 @@ class ResultConverter:
             raise ValueError('The results are not loaded.')
         if output_path.exists():
             raise ValueError('Destination already exists.')
+        clone_results = [r for r in self.results if len(r.clone_pairs) > 0]
+        if len(clone_results) == 0:
+            logging.info('No clone pair is found in the results.')
+            return
         output_path.mkdir(0o755)
-        n_clone_result = 0
-        for r in self.results:
-            if len(r.clone_pairs) == 0:
-                continue
-            clone_result_path = output_path.joinpath('result_{:06}'.format(n_clone_result))
-            clone_result_path.mkdir(0o755)
-            ResultConverter.pretty_print_result_to(clone_result_path.joinpath(ResultConverter.JOB_RESULT_FILE_NAME), r)
-            n_pairs = 0
-            for p in r.clone_pairs:
-                clone_pair_directory_path = clone_result_path.joinpath('pair_{:06}'.format(n_pairs))
-                clone_pair_directory_path.mkdir(0o755)
-                project_source_content = self.get_project_source_file_content(r.project.location)
-                example_sketch_source_content = self.get_example_sketch_source_file_content(
+        try:
+            for (n_clone_result, r) in enumerate(clone_results):
+                # The sources are the same for all the clone pairs of the result
+                example_sketch_source = self.get_example_sketch_source_file_content(
                     r.job_library_info.location,
                     r.job_library_info.archive_root,
                     r.example_sketch.location
                 )
-                ResultConverter.extract_clone_pair_to(
-                    clone_pair_directory_path,
-                    p,
-                    project_source_content,
-                    example_sketch_source_content
-                )
-                n_pairs += 1
-            n_clone_result += 1
+                if example_sketch_source is None:
+                    logging.error('Skipping the result of the unreadable example sketch: {}'.format(
+                        r.example_sketch.location))
+                    continue
+                example_sketch_source_lines = SourceLines(example_sketch_source)
+                project_source_lines = self.get_project_source_file_lines(r.project.location)
+                clone_result_path = output_path.joinpath('result_{:06}'.format(n_clone_result))
+                clone_result_path.mkdir(0o755)
+                ResultConverter.pretty_print_result_to(clone_result_path.joinpath(ResultConverter.JOB_RESULT_FILE_NAME), r)
+                for (n_pairs, p) in enumerate(r.clone_pairs):
+                    clone_pair_directory_path = clone_result_path.joinpath('pair_{:06}'.format(n_pairs))
+                    clone_pair_directory_path.mkdir(0o755)
+                    ResultConverter.extract_clone_pair_to(
+                        clone_pair_directory_path,
+                        p,
+                        project_source_lines,
+                        example_sketch_source_lines
+                    )
+        finally:
+            self.close_archives()
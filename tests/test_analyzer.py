@@ -0,0 +1,56 @@
+import unittest
+import tempfile
+from pathlib import Path
+import analyzer
+import database
+
+
+class TestArchiveEntryClassifier(unittest.TestCase):
+    FILENAMES = [
+        'Foo/',
+        'Foo/src/',
+        'Foo/src/Foo.h',
+        'Foo/src/Bar.hpp',
+        'Foo/src/Foo.cpp',
+        'Foo/src/utility/Deep.h',
+        'Foo/src/.h',
+        'Foo/Root.h',
+        'Foo/library.properties',
+        'Foo/examples/',
+        'Foo/examples/Basic/',
+        'Foo/examples/Basic/Basic.ino',
+        'Foo/examples/Group/Advanced/Advanced.pde',
+        'Foo/examples/Group/Advanced/helper.h',
+        'Foo/examples/Mismatch/Other.ino',
+    ]
+
+    def test_classify_archive_entries(self):
+        (src_headers, root_headers, sketches) = analyzer.Analyzer.classify_archive_entries(
+            TestArchiveEntryClassifier.FILENAMES)
+        self.assertEqual(['Foo.h', 'Bar.hpp'], src_headers)
+        self.assertEqual(['Root.h'], root_headers)
+        self.assertEqual(['Foo/examples/Basic/Basic.ino', 'Foo/examples/Group/Advanced/Advanced.pde'], sketches)
+
+
+class TestAnalysisCache(unittest.TestCase):
+    ENTRY = {
+        'stamp': {'mtime_ns': 1, 'size': 2},
+        'headers': ['Foo.h'],
+        'examples': [{'name': 'Basic', 'headers': ['Foo.h']}],
+    }
+
+    def test_analysis_cache_version(self):
+        with tempfile.TemporaryDirectory() as d:
+            db = database.Database(Path(d, 'db'), Path(d, 'parse_cache.key'))
+            db.secure_root_directory()
+            an = analyzer.Analyzer(db, Path(d, 'temp'))
+            an.write_analysis_cache({'libraries/Foo/1.0.0/Foo.zip': TestAnalysisCache.ENTRY})
+            self.assertEqual({'libraries/Foo/1.0.0/Foo.zip': TestAnalysisCache.ENTRY}, an.read_analysis_cache())
+            # The results of the other analyzer versions are not reused
+            db.write_toml_cached(Path(d, 'db', analyzer.Analyzer.ANALYSIS_CACHE_FILENAME),
+                                 {'libraries/Foo/1.0.0/Foo.zip': TestAnalysisCache.ENTRY})
+            self.assertEqual({}, an.read_analysis_cache())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+import unittest
+import tempfile
+import datetime
+import hashlib
+import pickle
+from pathlib import Path
+import database
+import library_index
+
+
+class TestFeatureDatabase(unittest.TestCase):
+    def setUp(self):
+        self.feature_data = database.FeatureDatabase()
+        self.feature_data.add_entries('Foo', '1.0.0', [
+            ('Basic', ['Foo.h']),
+            ('WithWire', ['Foo.h', 'Wire.h']),
+            ('NoHeaders', []),
+        ])
+        self.feature_data.add_entries('Bar', '2.0.0', [
+            ('Basic', ['Bar.h']),
+        ])
+        self.feature_data.add_entries('Foo', '1.1.0', [
+            ('Basic', ['Foo.h']),
+        ])
+
+    def test_search_all_for_headers(self):
+        self.assertEqual(
+            [('Foo', '1.0.0', 'Basic'), ('Foo', '1.1.0', 'Basic')],
+            self.feature_data.search_all_for_headers(['Foo.h']))
+        self.assertEqual(
+            [('Foo', '1.0.0', 'Basic'), ('Foo', '1.0.0', 'WithWire'), ('Foo', '1.1.0', 'Basic'), ('Bar', '2.0.0', 'Basic')],
+            self.feature_data.search_all_for_headers(['Wire.h', 'Bar.h', 'Foo.h', 'SPI.h']))
+        self.assertEqual([], self.feature_data.search_all_for_headers([]))
+
+    def test_search_after_adding_entries(self):
+        self.assertEqual([], self.feature_data.search_all_for_headers(['Baz.h']))
+        self.feature_data.add_entry('Baz', '0.1.0', 'Basic', ['Baz.h'])
+        self.assertEqual([('Baz', '0.1.0', 'Basic')], self.feature_data.search_all_for_headers(['Baz.h']))
+
+    def test_serialize_roundtrip(self):
+        serialized = self.feature_data.serialize()
+        restored = database.FeatureDatabase()
+        restored.deserialize(serialized)
+        self.assertEqual(serialized, restored.serialize())
+        self.assertEqual(
+            self.feature_data.search_all_for_headers(['Foo.h', 'Wire.h']),
+            restored.search_all_for_headers(['Foo.h', 'Wire.h']))
+
+
+# Base of the tests that create a Database. The parse cache key is kept in a temporary directory instead of the home
+# directory of the user.
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_path = Path(temp_dir.name)
+        self.key_path = Path(self.temp_path, 'parse_cache.key')
+
+    def create_database(self, directory, key_path=None):
+        return database.Database(directory, key_path if key_path is not None else self.key_path)
+
+
+class TestHeaderDictionary(DatabaseTestCase):
+    def test_remove_header_dictionary_entries(self):
+        db = self.create_database('munin-test-database')
+        foo = database.LibraryInfo('Foo', '1.0.0', None)
+        bar = database.LibraryInfo('Bar', '2.0.0', None)
+        db.add_header_dictionary_entry(foo, ['Foo.h', 'Common.h'])
+        db.add_header_dictionary_entry(bar, ['Bar.h', 'Common.h'])
+        db.remove_header_dictionary_entries(foo)
+        self.assertEqual([], db.search('Foo.h'))
+        self.assertEqual([{'name': 'Bar', 'version': '2.0.0'}], db.search('Common.h'))
+        db.add_header_dictionary_entry(foo, ['Foo.hpp'])
+        db.remove_header_dictionary_entries(foo)
+        self.assertEqual({'Bar.h', 'Common.h'}, set(db.header_dict.keys()))
+
+    def test_write_and_read_header_dictionary(self):
+        d = Path(self.temp_path, 'db')
+        db = self.create_database(d)
+        db.header_dict = {'a\\xb.h': {('Foo', '1.0.0')}, 'Foo "bar".h': {('Foo', '1.0.0'), ('Bar', '2.0.0')}}
+        db.is_header_dict_pending = False
+        db.write_header_dictionary()
+        # The file itself must be valid TOML, not only its parse cache
+        Path(d, database.Database.HEADER_DICTIONARY_FILENAME + database.Database.PARSE_CACHE_SUFFIX).unlink()
+        restored = self.create_database(d)
+        restored.read_header_dictionary()
+        self.assertEqual(db.header_dict, restored.header_dict)
+
+
+class TestLibraryIndex(DatabaseTestCase):
+    def test_write_and_read_library_index(self):
+        index = library_index.LibraryIndex([
+            {'name': 'Foo', 'version': '1.0.0', 'url': None, 'dependencies': [{'name': 'Bar', 'version': None}]},
+        ])
+        index.set_access_date(datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc))
+        d = Path(self.temp_path, 'db')
+        db = self.create_database(d)
+        db.write_library_index(index)
+        cached = db.read_library_index()
+        # The parse cache must hold the same data as the file
+        Path(d, database.Database.LIBRARY_INDEX_FILENAME + database.Database.PARSE_CACHE_SUFFIX).unlink()
+        parsed = db.read_library_index()
+        self.assertEqual([{'name': 'Foo', 'version': '1.0.0', 'dependencies': [{'name': 'Bar'}]}], cached.libs)
+        self.assertEqual(parsed.libs, cached.libs)
+        self.assertEqual(parsed.access_date, cached.access_date)
+        self.assertIsNone(cached.etag)
+
+    def test_read_existing_library_index(self):
+        d = Path(self.temp_path, 'db')
+        db = self.create_database(d)
+        self.assertIsNone(db.read_existing_library_index())
+        # The older versions wrote the backslashes without escaping them
+        db.secure_root_directory()
+        Path(d, database.Database.LIBRARY_INDEX_FILENAME).write_text('access_date = 2021-01-01T00:00:00Z\n'
+                                                                     '[[libs]]\nname = "C:\\path\\x"\n')
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(db.read_existing_library_index())
+
+
+class TestParseCache(DatabaseTestCase):
+    def test_ignore_parse_cache_of_other_user(self):
+        d = Path(self.temp_path, 'db')
+        db = self.create_database(d)
+        db.secure_root_directory()
+        toml_path = Path(d, 'data.toml')
+        db.write_toml_cached(toml_path, {'value': 1})
+        self.assertEqual({'value': 1}, db.read_toml_cached(toml_path))
+        # The same cache is not trusted with another key
+        cache_path = db.get_parse_cache_path(toml_path)
+        digest = hashlib.sha256(toml_path.read_bytes()).digest()
+        cache_path.write_bytes(cache_path.read_bytes()[:32] + pickle.dumps((digest, {'value': 2})))
+        other = self.create_database(d, Path(self.temp_path, 'other.key'))
+        self.assertEqual({'value': 1}, other.read_toml_cached(toml_path))
+        self.assertEqual({'value': 1}, db.read_toml_cached(toml_path))
+
+
+class TestExampleSources(unittest.TestCase):
+    FILENAMES = [
+        'Foo/',
+        'Foo/src/Foo.h',
+        'Foo/examples/Basic/Basic.ino',
+        'Foo/examples/Basic/helper.h',
+        'Foo/examples/Group/Advanced/Advanced.ino',
+        'Foo/examples/README.md',
+        'Foo/examples/Basic/data.txt',
+    ]
+
+    def test_find_example_sources(self):
+        self.assertEqual(
+            [('Foo/examples/Basic/Basic.ino', 'Basic'),
+             ('Foo/examples/Basic/helper.h', 'Basic'),
+             ('Foo/examples/Group/Advanced/Advanced.ino', 'Group/Advanced')],
+            database.Database.find_example_sources(TestExampleSources.FILENAMES))
+        self.assertEqual(
+            [('Foo/examples/Group/Advanced/Advanced.ino', 'Group/Advanced')],
+            database.Database.find_example_sources(TestExampleSources.FILENAMES, ['Group/Advanced']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+import datetime
+import library_index
+
+
+class TestCacheValidators(unittest.TestCase):
+    DATE = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def test_no_conditional_headers_without_validators(self):
+        index = library_index.from_database_toml_dict({'libs': [], 'access_date': TestCacheValidators.DATE})
+        self.assertEqual({}, index.get_conditional_request_headers())
+
+    def test_conditional_headers(self):
+        index = library_index.from_database_toml_dict({
+            'libs': [],
+            'access_date': TestCacheValidators.DATE,
+            'etag': '"abc"',
+            'last_modified': 'Fri, 01 Jan 2021 00:00:00 GMT',
+        })
+        self.assertEqual({
+            'If-None-Match': '"abc"',
+            'If-Modified-Since': 'Fri, 01 Jan 2021 00:00:00 GMT',
+        }, index.get_conditional_request_headers())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
 import unittest
+import tempfile
+from pathlib import Path
 import result
 
 
@@ -23,6 +25,29 @@ class TestCodeSlice(unittest.TestCase):
                          "  return\n",
                          res)
 
+    def test_get_nearby_from_lines(self):
+        code_slice = result.CodeSlice(
+            result.CodePosition(4, 3),
+            result.CodePosition(4, 8),
+        )
+        source_lines = result.SourceLines(TestCodeSlice.SOURCE_CODE.encode('ascii'))
+        res = code_slice.get_nearby_from_lines(source_lines, width=1)
+        self.assertEqual(b"int main(void) {\n"
+                         b"  printf(\"Hello, world!\\n\");\n",
+                         res)
+
+
+class TestResultConverter(unittest.TestCase):
+    def test_open_missing_archive(self):
+        with tempfile.TemporaryDirectory() as d:
+            converter = result.ResultConverter(d, Path(d))
+            with self.assertLogs(level='ERROR') as logs:
+                self.assertIsNone(converter.get_example_sketch_source_file_content('Foo/1.0.0/Foo.zip', 'Foo', 'A/A.ino'))
+                self.assertIsNone(converter.open_archive('Foo/1.0.0/Foo.zip'))
+            # The failure is reported only once
+            self.assertEqual(1, len(logs.output))
+            converter.close_archives()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+import util
+
+
+class TestIncludedHeaders(unittest.TestCase):
+    SOURCE_CODE = "#include <Wire.h>\n" \
+                  "  #include \"Foo.hpp\"  \r\n" \
+                  "#include <stdio.c>\n" \
+                  "// #include <Commented.h>\n" \
+                  "#include<NoSpace.h>\n" \
+                  "\n" \
+                  "void setup() {}\n"
+
+    def test_get_included_headers_from_source_code(self):
+        res = util.get_included_headers_from_source_code(TestIncludedHeaders.SOURCE_CODE)
+        self.assertEqual(['Wire.h', 'Foo.hpp'], res)
+
+    def test_get_included_headers_from_source_code_bytes(self):
+        res = util.get_included_headers_from_source_code_bytes(TestIncludedHeaders.SOURCE_CODE.encode('ascii'))
+        self.assertEqual(['Wire.h', 'Foo.hpp'], res)
+
+    def test_get_included_headers_from_source_code_bytes_line_breaks(self):
+        res = util.get_included_headers_from_source_code_bytes(b'#include <A.h>\r#include <B.h> #include <C.h>\r\n'
+                                                               b'int a; #include <D.h>\n#include <E.h>')
+        self.assertEqual(['A.h', 'B.h> #include <C.h', 'E.h'], res)
+
+    def test_get_included_headers_from_source_code_bytes_same_as_str(self):
+        source = '#include <A.h>\x0b#include <B.h>\x0c int a; #include <C.h> #include <D.h>\x85\x1f#include <E.h>\n' \
+                 '#include <F\x1ef.h>\r\n#include <Gé.h>'
+        self.assertEqual(['A.h', 'B.h', 'D.h', 'E.h', 'Gé.h'], util.get_included_headers_from_source_code(source))
+        self.assertEqual(util.get_included_headers_from_source_code(source),
+                         util.get_included_headers_from_source_code_bytes(source.encode('utf-8')))
+
+
+if __name__ == '__main__':
+    unittest.main()
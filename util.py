@@ -1,15 +1,80 @@
 import logging
 import re
+from progress.bar import Bar
+
+_RE_INCLUDE = re.compile(r'#include ("|<)(.+[.](h|hpp))("|>)')
+_RE_LINE_BREAK_BYTES = re.compile(rb'[\r\n]')
+
+
+# Progress bar that redraws only after every 1/MAX_REDRAWS of the work instead of on every next() call.
+class BatchedBar(Bar):
+    MAX_REDRAWS = 200
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stride = max(1, self.max // BatchedBar.MAX_REDRAWS)
+        self._pending = 0
+
+    def next(self, n=1):
+        self._pending += n
+        if self._pending >= self._stride:
+            super().next(self._pending)
+            self._pending = 0
+
+    def finish(self):
+        if self._pending > 0:
+            super().next(self._pending)
+            self._pending = 0
+        super().finish()
+
+
+# Returns the initargs for init_worker_logging that reproduce the logging configuration of this process.
+def get_worker_logging_config():
+    root = logging.getLogger()
+    log_filenames = [h.baseFilename for h in root.handlers if isinstance(h, logging.FileHandler)]
+    return (log_filenames[0] if len(log_filenames) > 0 else None), root.level
+
+
+# Initializer of the process pools whose workers log.
+# The workers started with spawn or forkserver (instead of fork) do not inherit the logging configuration, so they
+# open the log file of the parent by themselves. (basicConfig does nothing in the forked workers that already have
+# the handlers.)
+def init_worker_logging(log_filename, level):
+    if log_filename is not None:
+        logging.basicConfig(filename=log_filename)
+    logging.getLogger().setLevel(level)
 
 
 def get_included_headers_from_source_code(source):
     res = []
     lines = source.splitlines()
     for line in lines:
+        # Most of the lines are not include directives, and the substring test is much cheaper than the match.
+        if '#include' not in line:
+            continue
         line = line.strip()
-        m = re.fullmatch(r'^#include ("|<)(.+[.](h|hpp))("|>)$', line)
+        m = _RE_INCLUDE.fullmatch(line)
         if m is not None:
             header = m.group(2)
             logging.debug('Include found: {}'.format(header))
             res.append(header)
     return res
+
+
+# Same as get_included_headers_from_source_code, but works on the raw bytes of the source code. This is valid for UTF-8
+# and the other ASCII compatible encodings, since the include directives are plain ASCII.
+# Instead of splitting all the lines, the occurrences of the directive are looked up in the whole source and only the
+# lines containing them are decoded and matched, so the result is the same as decoding the source as UTF-8 (with
+# the replacement characters) and passing it to get_included_headers_from_source_code.
+def get_included_headers_from_source_code_bytes(source):
+    res = []
+    line_end = 0
+    pos = source.find(b'#include')
+    while pos >= 0:
+        line_start = max(source.rfind(b'\n', line_end, pos), source.rfind(b'\r', line_end, pos)) + 1
+        m = _RE_LINE_BREAK_BYTES.search(source, pos)
+        line_end = m.start() if m is not None else len(source)
+        # The lines are split further at the other line breaks of str.splitlines(), which are rare
+        res.extend(get_included_headers_from_source_code(source[line_start:line_end].decode('utf-8', errors='replace')))
+        pos = source.find(b'#include', line_end)
+    return res